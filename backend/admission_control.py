@@ -0,0 +1,234 @@
+"""
+Admission control and backpressure for the upload API
+"""
+
+import os
+import math
+import time
+import asyncio
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Any, Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request does not fit the admission budget"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[int], reason: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionController:
+    """Bounds admitted uploads by document count, bytes and per-client concurrency
+
+    Requests that do not fit wait in a short bounded FIFO queue, and new
+    requests queue behind waiting ones rather than overtaking them. When the
+    queue is full or the wait times out they are rejected with 503, and
+    clients over their own limit are rejected with 429; both carry a
+    Retry-After estimate. Requests that can never fit get 413 without one.
+    """
+
+    def __init__(self, max_in_flight: int = 16, max_in_flight_bytes: int = 256 * 1024 * 1024,
+                 max_queued: int = 32, queue_timeout: float = 10.0, per_client_limit: int = 4):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.per_client_limit = per_client_limit
+
+        self._cond = asyncio.Condition()
+        self._in_flight = 0
+        self._in_flight_bytes = 0
+        # Tickets of queued requests, admitted strictly in arrival order
+        self._waiters: Deque[object] = deque()
+        self._per_client: Dict[str, int] = defaultdict(int)
+        self._admitted = 0
+        self._rejected: Dict[str, int] = defaultdict(int)
+        # Moving average of how long an admitted request holds its slot
+        self._avg_service_seconds = 5.0
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        return cls(
+            max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "16")),
+            max_in_flight_bytes=int(os.getenv("ADMISSION_MAX_IN_FLIGHT_BYTES", str(256 * 1024 * 1024))),
+            max_queued=int(os.getenv("ADMISSION_MAX_QUEUED", "32")),
+            queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10")),
+            per_client_limit=int(os.getenv("ADMISSION_PER_CLIENT_LIMIT", "4"))
+        )
+
+    @asynccontextmanager
+    async def admit(self, client_id: str, size: int):
+        """Hold an admission slot for the duration of the block"""
+        async with self._cond:
+            # It could never fit, so waiting would only hold a queue slot until the timeout
+            if size > self.max_in_flight_bytes:
+                self.record_rejection("too_large")
+                raise AdmissionRejected(413, "Request is larger than the server's upload budget", None, "too_large")
+
+            if self._per_client.get(client_id, 0) >= self.per_client_limit:
+                self._reject(429, "Too many concurrent uploads from this client", "client_limit")
+
+            if self._waiters or not self._fits(size):
+                if len(self._waiters) >= self.max_queued:
+                    self._reject(503, "Server is at capacity, please retry later", "queue_full")
+                await self._wait_for_slot(client_id, size)
+
+            self._in_flight += 1
+            self._in_flight_bytes += size
+            self._per_client[client_id] += 1
+            self._admitted += 1
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._in_flight -= 1
+                self._in_flight_bytes -= size
+                self._release_client(client_id)
+                elapsed = time.monotonic() - started
+                self._avg_service_seconds = 0.8 * self._avg_service_seconds + 0.2 * elapsed
+                self._cond.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self._in_flight,
+            "in_flight_bytes": self._in_flight_bytes,
+            "queued": len(self._waiters),
+            "clients": len(self._per_client),
+            "admitted": self._admitted,
+            "rejected": dict(self._rejected),
+            "limits": {
+                "max_in_flight": self.max_in_flight,
+                "max_in_flight_bytes": self.max_in_flight_bytes,
+                "max_queued": self.max_queued,
+                "per_client_limit": self.per_client_limit
+            }
+        }
+
+    def record_rejection(self, reason: str):
+        """Count a request rejected outside admit, e.g. for its size"""
+        self._rejected[reason] += 1
+
+    async def _wait_for_slot(self, client_id: str, size: int):
+        """Wait in the bounded queue until first in line and the request fits; caller holds the lock"""
+        ticket = object()
+        self._waiters.append(ticket)
+        # Queued requests count toward the client's limit too
+        self._per_client[client_id] += 1
+        try:
+            await asyncio.wait_for(
+                self._cond.wait_for(lambda: self._waiters[0] is ticket and self._fits(size)),
+                self.queue_timeout
+            )
+        except asyncio.TimeoutError:
+            self._reject(503, "Timed out waiting for capacity, please retry later", "queue_timeout")
+        finally:
+            self._waiters.remove(ticket)
+            self._release_client(client_id)
+            # The next request in line may fit now
+            self._cond.notify_all()
+
+    def _fits(self, size: int) -> bool:
+        return (self._in_flight < self.max_in_flight
+                and self._in_flight_bytes + size <= self.max_in_flight_bytes)
+
+    def _release_client(self, client_id: str):
+        self._per_client[client_id] -= 1
+        if self._per_client[client_id] <= 0:
+            del self._per_client[client_id]
+
+    def _retry_after(self) -> int:
+        """Seconds until the current backlog is expected to drain"""
+        backlog = len(self._waiters) + 1
+        return max(1, math.ceil(self._avg_service_seconds * backlog / max(self.max_in_flight, 1)))
+
+    def _reject(self, status_code: int, detail: str, reason: str):
+        self._rejected[reason] += 1
+        raise AdmissionRejected(status_code, detail, self._retry_after(), reason)
+
+
+class AdmissionMiddleware:
+    """ASGI middleware that applies admission control and a request size cap per path
+
+    Requests whose Content-Length exceeds max_request_bytes are rejected with
+    413 before admission. Requests without a length are charged the full cap
+    and their body stream is cut off with 413 as soon as it goes over.
+    """
+
+    def __init__(self, app: ASGIApp, controllers: Dict[str, AdmissionController], max_request_bytes: int):
+        self.app = app
+        self.controllers = controllers
+        self.max_request_bytes = max_request_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        controller = self.controllers.get(scope.get("path")) if scope["type"] == "http" else None
+        if controller is None or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        content_length = headers.get(b"content-length", b"").decode("latin-1")
+        if content_length.isdigit() and int(content_length) > self.max_request_bytes:
+            controller.record_rejection("too_large")
+            await self._respond(scope, receive, send, 413, "Request body too large")
+            return
+        size = int(content_length) if content_length.isdigit() else self.max_request_bytes
+
+        client = scope.get("client")
+        client_id = client[0] if client else "unknown"
+        try:
+            async with controller.admit(client_id, size):
+                await self._call_limited(scope, receive, send, controller)
+        except AdmissionRejected as e:
+            await self._respond(scope, receive, send, e.status_code, e.detail, e.retry_after)
+
+    async def _call_limited(self, scope: Scope, receive: Receive, send: Send, controller: AdmissionController):
+        """Run the app with its body stream capped at max_request_bytes"""
+        received = 0
+        response_started = False
+        rejected = False
+
+        async def limited_receive() -> Message:
+            nonlocal received, rejected
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+            received += len(message.get("body", b""))
+            if received > self.max_request_bytes and not rejected:
+                rejected = True
+                controller.record_rejection("too_large")
+                if not response_started:
+                    await JSONResponse(
+                        status_code=413, content={"detail": "Request body too large"}
+                    )(scope, receive, send)
+            if rejected:
+                # Tell the app the client went away so it stops reading and parsing
+                return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message: Message):
+            nonlocal response_started
+            if rejected:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not rejected:
+                raise
+
+    async def _respond(self, scope: Scope, receive: Receive, send: Send, status_code: int, detail: str,
+                       retry_after: Optional[int] = None):
+        headers = {"Retry-After": str(retry_after)} if retry_after is not None else None
+        await JSONResponse(status_code=status_code, content={"detail": detail}, headers=headers)(scope, receive, send)
@@ -0,0 +1,245 @@
+"""
+Priority-, fairness- and deadline-aware scheduling of invoice analysis work
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Any, Deque, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from invoice_ex import InvoiceProcessor
+
+# Lower value runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_REPROCESS = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BATCH: "batch",
+    PRIORITY_REPROCESS: "reprocess"
+}
+
+
+class DeadlineExceededError(RuntimeError):
+    """Raised for jobs whose deadline passed before they could start"""
+
+
+class _Job:
+    def __init__(self, file_path: Path, priority: int, submitter: str, deadline: Optional[float],
+                 output: Optional[Dict[str, Any]]):
+        self.file_path = file_path
+        self.output = output
+        self.priority = priority
+        self.submitter = submitter
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.future: Future = Future()
+
+
+class AnalysisScheduler:
+    """Runs InvoiceProcessor work on a worker pool in priority order
+
+    Classes are served strictly by priority. Within a class, submitters are
+    served round-robin, except that queued jobs with a deadline go earliest
+    deadline first. Batch and reprocess work may never occupy the workers
+    reserved for interactive requests, so backfills only use leftover capacity.
+    Queued jobs whose deadline passes are failed promptly, even while their
+    class is held back.
+    """
+
+    def __init__(self, processor: "InvoiceProcessor", workers: int = 4, reserved_interactive: int = 1,
+                 expiry_interval: float = 0.5):
+        if workers < 1:
+            raise ValueError("Scheduler needs at least one worker")
+        self.processor = processor
+        self.workers = workers
+        self.reserved_interactive = min(reserved_interactive, workers - 1)
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Job]]"] = {
+            priority: OrderedDict() for priority in PRIORITY_NAMES
+        }
+        self._running: Dict[int, int] = {priority: 0 for priority in PRIORITY_NAMES}
+        self._wait_times: Dict[int, Deque[float]] = {
+            priority: deque(maxlen=1000) for priority in PRIORITY_NAMES
+        }
+        self._expired = 0
+        self._queued_with_deadline = 0
+        self.expiry_interval = expiry_interval
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+        self._stopped = False
+
+    @classmethod
+    def from_env(cls, processor: "InvoiceProcessor") -> "AnalysisScheduler":
+        return cls(
+            processor,
+            workers=int(os.getenv("SCHEDULER_WORKERS", "4")),
+            reserved_interactive=int(os.getenv("SCHEDULER_RESERVED_INTERACTIVE", "1"))
+        )
+
+    def start(self):
+        """Start the worker threads"""
+        with self._cond:
+            if self._threads:
+                return
+            self._stopped = False
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker_loop, name=f"analysis-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            # Workers may all be busy, so deadlines are enforced by a thread of their own
+            thread = threading.Thread(target=self._expiry_loop, name="analysis-expiry", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop accepting work and let the workers exit once idle"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def submit(self, file_path: Path, priority: int = PRIORITY_INTERACTIVE, submitter: str = "default",
+               deadline_seconds: Optional[float] = None, output: Optional[Dict[str, Any]] = None) -> Future:
+        """Queue a file for analysis; the future resolves to (preap_data, error)"""
+        if priority not in PRIORITY_NAMES:
+            raise ValueError(f"Unknown priority: {priority}")
+        deadline = time.monotonic() + deadline_seconds if deadline_seconds is not None else None
+        job = _Job(file_path, priority, submitter, deadline, output)
+
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Scheduler is stopped")
+            self._queues[priority].setdefault(submitter, deque()).append(job)
+            if deadline is not None:
+                self._queued_with_deadline += 1
+            self._cond.notify()
+        return job.future
+
+    def process(self, file_path: Path, priority: int = PRIORITY_INTERACTIVE, submitter: str = "default",
+                deadline_seconds: Optional[float] = None,
+                output: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """Blocking variant of submit with the InvoiceProcessor return convention"""
+        try:
+            return self.submit(file_path, priority, submitter, deadline_seconds, output).result()
+        except DeadlineExceededError as e:
+            return None, str(e)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue depth, running jobs and recent queue wait per priority class"""
+        with self._cond:
+            stats = {"workers": self.workers, "expired": self._expired, "classes": {}}
+            for priority, name in PRIORITY_NAMES.items():
+                waits = sorted(self._wait_times[priority])
+                stats["classes"][name] = {
+                    "queued": sum(len(q) for q in self._queues[priority].values()),
+                    "submitters": len(self._queues[priority]),
+                    "running": self._running[priority],
+                    "wait_p95_seconds": waits[int(len(waits) * 0.95)] if waits else None
+                }
+            return stats
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                job.future.set_result(self.processor.process_invoice(job.file_path, job.output))
+            except Exception as e:
+                job.future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running[job.priority] -= 1
+                    self._cond.notify_all()
+
+    def _next_job(self) -> Optional[_Job]:
+        with self._cond:
+            while True:
+                self._expire_overdue()
+                job = self._pop_runnable()
+                if job is not None:
+                    return job
+                if self._stopped:
+                    return None
+                self._cond.wait(timeout=1.0)
+
+    def _expiry_loop(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                self._expire_overdue()
+            time.sleep(self.expiry_interval)
+
+    def _expire_overdue(self):
+        """Fail every queued job whose deadline has passed, in all classes; caller holds the lock"""
+        if not self._queued_with_deadline:
+            return
+        now = time.monotonic()
+        for submitters in self._queues.values():
+            for name in list(submitters):
+                queue = submitters[name]
+                overdue = [job for job in queue if job.deadline is not None and now > job.deadline]
+                if not overdue:
+                    continue
+                for job in overdue:
+                    queue.remove(job)
+                    self._queued_with_deadline -= 1
+                    self._expire(job)
+                if not queue:
+                    del submitters[name]
+
+    def _expire(self, job: _Job):
+        self._expired += 1
+        job.future.set_exception(DeadlineExceededError(
+            f"Deadline passed before analysis of {job.file_path.name} could start"
+        ))
+
+    def _pop_runnable(self) -> Optional[_Job]:
+        """Pick the next job; caller holds the lock"""
+        background_running = sum(
+            count for priority, count in self._running.items() if priority != PRIORITY_INTERACTIVE
+        )
+        background_limit = self.workers - self.reserved_interactive
+
+        for priority in sorted(self._queues):
+            if priority != PRIORITY_INTERACTIVE and background_running >= background_limit:
+                # Defer lower-priority work so interactive requests always find a worker
+                break
+            job = self._pop_from_class(priority)
+            if job is not None:
+                self._running[priority] += 1
+                self._wait_times[priority].append(time.monotonic() - job.enqueued_at)
+                return job
+        return None
+
+    def _pop_from_class(self, priority: int) -> Optional[_Job]:
+        submitters = self._queues[priority]
+        now = time.monotonic()
+
+        while submitters:
+            with_deadline = [
+                (queue[0].deadline, name) for name, queue in submitters.items() if queue[0].deadline is not None
+            ]
+            # Earliest deadline first, otherwise round-robin across submitters
+            name = min(with_deadline)[1] if with_deadline else next(iter(submitters))
+            queue = submitters[name]
+            job = queue.popleft()
+            if queue:
+                submitters.move_to_end(name)
+            else:
+                del submitters[name]
+
+            if job.deadline is not None:
+                self._queued_with_deadline -= 1
+                if now > job.deadline:
+                    self._expire(job)
+                    continue
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            return job
+        return None
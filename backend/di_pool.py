@@ -0,0 +1,285 @@
+"""
+Endpoint pool for Azure Document Intelligence with routing, health tracking
+and a shared keep-alive transport
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.core.pipeline.transport import RequestsTransport
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+
+T = TypeVar("T")
+
+ROUTING_ROUND_ROBIN = "round_robin"
+ROUTING_LEAST_OUTSTANDING = "least_outstanding"
+
+# HTTP statuses that say something about the resource rather than the document
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class NoHealthyEndpointError(RuntimeError):
+    """Raised when every endpoint in the pool has an open circuit"""
+
+
+class PoolMember:
+    """A single Document Intelligence resource and its health state"""
+
+    def __init__(self, endpoint: str, key: str, weight: int, transport: RequestsTransport):
+        self.endpoint = endpoint
+        self.weight = max(1, weight)
+        # Default SDK retries apply to polling; submit calls override them per call
+        self.client = DocumentIntelligenceClient(
+            endpoint=endpoint,
+            credential=AzureKeyCredential(key),
+            transport=transport
+        )
+        self.outstanding = 0
+        self.current_weight = 0
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_probe = False
+        # Throttling is not a health failure: the endpoint is skipped until its Retry-After passes
+        self.throttled_until = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.total_throttled = 0
+
+    def is_available(self, now: float, cooldown: float) -> bool:
+        """Closed circuits are available; open ones only after the cooldown, one probe at a time"""
+        if self.opened_at is None:
+            return True
+        return now - self.opened_at >= cooldown and not self.half_open_probe
+
+    def is_throttled(self, now: float) -> bool:
+        return now < self.throttled_until
+
+    def stats(self) -> dict:
+        return {
+            "endpoint": self.endpoint,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "circuit": "open" if self.opened_at is not None else "closed",
+            "throttled": self.is_throttled(time.monotonic()),
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "total_throttled": self.total_throttled
+        }
+
+
+class DocumentIntelligencePool:
+    """Routes calls across several Document Intelligence resources"""
+
+    def __init__(self, endpoints: List[str], keys: List[str], weights: Optional[List[int]] = None,
+                 routing: str = ROUTING_ROUND_ROBIN, pool_size: int = 10,
+                 failure_threshold: int = 3, cooldown_seconds: float = 30.0, submit_retry_total: int = 0,
+                 throttle_timeout: float = 120.0):
+        if not endpoints:
+            raise ValueError("At least one Document Intelligence endpoint is required")
+        if len(keys) == 1 and len(endpoints) > 1:
+            keys = keys * len(endpoints)
+        if len(keys) != len(endpoints):
+            raise ValueError("Number of API keys must match number of endpoints")
+        weights = weights or [1] * len(endpoints)
+        if len(weights) != len(endpoints):
+            raise ValueError("Number of weights must match number of endpoints")
+        if routing not in (ROUTING_ROUND_ROBIN, ROUTING_LEAST_OUTSTANDING):
+            raise ValueError(f"Unknown routing strategy: {routing}")
+
+        self.routing = routing
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        # SDK retries for submit calls only, so a throttled endpoint is reported and skipped right away
+        self.submit_retry_total = submit_retry_total
+        # How long a submission may wait for a throttled pool before giving up
+        self.throttle_timeout = throttle_timeout
+        self._lock = threading.Lock()
+
+        # One keep-alive session shared by every client in the pool
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(endpoints), pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self.transport = RequestsTransport(session=self._session, session_owner=False)
+
+        self.members = [
+            PoolMember(endpoint.strip(), key.strip(), weight, self.transport)
+            for endpoint, key, weight in zip(endpoints, keys, weights)
+        ]
+
+    @classmethod
+    def from_credentials(cls, endpoint: str, key: str) -> "DocumentIntelligencePool":
+        """Build a pool from comma-separated endpoint/key strings plus optional env tuning"""
+        endpoints = [e for e in endpoint.split(",") if e.strip()]
+        keys = [k for k in key.split(",") if k.strip()]
+        weights_env = os.getenv("DOCUMENTINTELLIGENCE_WEIGHTS")
+        weights = [int(w) for w in weights_env.split(",")] if weights_env else None
+
+        return cls(
+            endpoints,
+            keys,
+            weights=weights,
+            routing=os.getenv("DOCUMENTINTELLIGENCE_ROUTING", ROUTING_ROUND_ROBIN),
+            pool_size=int(os.getenv("DOCUMENTINTELLIGENCE_POOL_SIZE", "10")),
+            failure_threshold=int(os.getenv("DOCUMENTINTELLIGENCE_FAILURE_THRESHOLD", "3")),
+            cooldown_seconds=float(os.getenv("DOCUMENTINTELLIGENCE_COOLDOWN_SECONDS", "30")),
+            submit_retry_total=int(os.getenv("DOCUMENTINTELLIGENCE_SUBMIT_RETRY_TOTAL", "0")),
+            throttle_timeout=float(os.getenv("DOCUMENTINTELLIGENCE_THROTTLE_TIMEOUT", "120"))
+        )
+
+    def call(self, fn: Callable[[DocumentIntelligenceClient], T]) -> T:
+        """Run fn against a selected client, failing over to other endpoints on transient errors"""
+        with self.submit(fn) as (_, result):
+            return result
+
+    @contextmanager
+    def submit(self, fn: Callable[[DocumentIntelligenceClient], T]) -> Iterator[Tuple[DocumentIntelligenceClient, T]]:
+        """Run fn with failover, then keep its endpoint counted as outstanding until the block exits
+
+        fn may be retried on another endpoint, so it must be safe to repeat:
+        submit work in fn (passing retry_total=submit_retry_total) and poll
+        long-running operations inside the block.
+        """
+        member, result = self._submit_with_failover(fn)
+        try:
+            yield member.client, result
+        finally:
+            self._finish(member)
+
+    def get_stats(self) -> List[dict]:
+        """Per-endpoint routing and health statistics"""
+        with self._lock:
+            return [member.stats() for member in self.members]
+
+    def close(self):
+        """Close the shared HTTP session"""
+        self._session.close()
+
+    def _submit_with_failover(self, fn: Callable[[DocumentIntelligenceClient], T]) -> Tuple[PoolMember, T]:
+        deadline = time.monotonic() + self.throttle_timeout
+        last_error: Optional[Exception] = None
+
+        while True:
+            tried = set()
+            for _ in range(len(self.members)):
+                try:
+                    member = self._select(exclude=tried)
+                except NoHealthyEndpointError:
+                    break
+                tried.add(id(member))
+
+                try:
+                    result = fn(member.client)
+                except Exception as e:
+                    self._finish(member)
+                    if self._is_throttled(e):
+                        self._throttle(member, self._retry_after(e))
+                        print(f"Endpoint throttled, trying next one: {member.endpoint}")
+                    else:
+                        transient = self.is_transient(e)
+                        self._record(member, success=not transient)
+                        if not transient:
+                            raise
+                        print(f"Endpoint failed, trying next one: {e}")
+                    last_error = e
+                    continue
+
+                self._record(member, success=True)
+                return member, result
+
+            # Every usable endpoint is throttled: wait for the first to free up instead of failing
+            wait = self._throttle_wait()
+            if wait is None or time.monotonic() + wait > deadline:
+                break
+            print(f"All endpoints throttled, retrying in {wait:.1f}s")
+            time.sleep(wait)
+
+        if last_error:
+            raise last_error
+        raise NoHealthyEndpointError("No healthy Document Intelligence endpoint available")
+
+    def _select(self, exclude: set) -> PoolMember:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [
+                m for m in self.members
+                if id(m) not in exclude and m.is_available(now, self.cooldown_seconds) and not m.is_throttled(now)
+            ]
+            if not candidates:
+                raise NoHealthyEndpointError("No healthy Document Intelligence endpoint available")
+
+            if self.routing == ROUTING_LEAST_OUTSTANDING:
+                member = min(candidates, key=lambda m: m.outstanding / m.weight)
+            else:
+                # Smooth weighted round-robin
+                total = sum(m.weight for m in candidates)
+                for m in candidates:
+                    m.current_weight += m.weight
+                member = max(candidates, key=lambda m: m.current_weight)
+                member.current_weight -= total
+
+            if member.opened_at is not None:
+                member.half_open_probe = True
+            member.outstanding += 1
+            member.total_requests += 1
+            return member
+
+    def _finish(self, member: PoolMember):
+        with self._lock:
+            member.outstanding -= 1
+
+    def _throttle(self, member: PoolMember, delay: float):
+        with self._lock:
+            # A throttled endpoint answered, so it is healthy; only its quota is exhausted
+            member.half_open_probe = False
+            member.total_throttled += 1
+            member.throttled_until = max(member.throttled_until, time.monotonic() + delay)
+
+    def _throttle_wait(self) -> Optional[float]:
+        """Seconds until the first throttled endpoint with a usable circuit frees up, if any"""
+        now = time.monotonic()
+        with self._lock:
+            waits = [
+                m.throttled_until - now for m in self.members
+                if m.is_throttled(now) and m.is_available(now, self.cooldown_seconds)
+            ]
+        return max(min(waits), 0.0) if waits else None
+
+    def _record(self, member: PoolMember, success: bool):
+        with self._lock:
+            member.half_open_probe = False
+            if success:
+                member.consecutive_failures = 0
+                member.opened_at = None
+                return
+
+            member.total_failures += 1
+            member.consecutive_failures += 1
+            if member.opened_at is not None or member.consecutive_failures >= self.failure_threshold:
+                print(f"Circuit opened for endpoint: {member.endpoint}")
+                member.opened_at = time.monotonic()
+
+    def _is_throttled(self, error: Exception) -> bool:
+        return isinstance(error, HttpResponseError) and error.status_code == 429
+
+    def _retry_after(self, error: HttpResponseError, default: float = 2.0) -> float:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        try:
+            return max(float(retry_after), 0.0)
+        except (TypeError, ValueError):
+            return default
+
+    def is_transient(self, error: Exception) -> bool:
+        """Connection errors, throttling and server errors count against the endpoint"""
+        if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+            return True
+        return getattr(error, "status_code", None) in _RETRYABLE_STATUS
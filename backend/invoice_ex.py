@@ -5,28 +5,46 @@ Invoice Processing with Azure Document Intelligence and PREAP Output
 import os
 import time
 import json
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Tuple, Optional, Dict, Any
+from typing import Tuple, Optional, Dict, Any, Union
+
+import requests
 from dotenv import find_dotenv, load_dotenv
-from azure.core.credentials import AzureKeyCredential
+from azure.core.polling import LROPoller
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeResult
 
+from di_pool import DocumentIntelligencePool
 from preap_builder import PreapBuilder
+from result_store import ResultStore, content_key, output_target, TIER_PREAP_OUTPUT
+from search_index import SearchIndex
+from storage_manager import ArchiveStore, StorageTier, EVICT_ARCHIVE, key_from_stem
+
+# Run summaries kept at the top of the output directory rather than sharded
+SUMMARY_FILES = ("processing_summary.json", "replay_summary.json")
 
 
 class InvoiceProcessor:
     """Process invoices using Azure Document Intelligence"""
     
-    def __init__(self, endpoint: str, key: str):
-        self.client = DocumentIntelligenceClient(
-            endpoint=endpoint, 
-            credential=AzureKeyCredential(key)
-        )
+    def __init__(self, endpoint: str, key: str, pool: Optional[DocumentIntelligencePool] = None,
+                 result_store: Optional[ResultStore] = None):
+        # endpoint/key may hold comma-separated lists to shard across several resources
+        self.pool = pool or DocumentIntelligencePool.from_credentials(endpoint, key)
         self.preap_builder = PreapBuilder()
+        # When set, raw results are recorded so outputs can be rebuilt without the service
+        self.result_store = result_store
     
-    def process_invoice(self, file_path: Path) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
-        """Process a single invoice file"""
+    def process_invoice(self, file_path: Path,
+                        output: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """Process a single invoice file
+
+        output (see result_store.output_target) names the served JSON file the
+        result is built into; its metadata is merged into preap_metadata and it
+        is recorded alongside the raw result so replay rebuilds that exact file.
+        """
         try:
             print(f"   📄 Reading file: {file_path.name}")
             if not file_path.exists():
@@ -35,19 +53,9 @@ class InvoiceProcessor:
             with open(file_path, "rb") as f:
                 file_content = f.read()
 
-            # Analyze with Azure Document Intelligence
-            poller = self.client.begin_analyze_document(
-                "prebuilt-invoice",
-                body=file_content,
-                content_type="application/octet-stream"
-            )
-            
-            # Show progress for long-running operations
-            while not poller.done():
-                print(" Still processing...")
-                time.sleep(2)
-            
-            analyze_result = poller.result()
+            # Submit to Azure Document Intelligence; only submission fails over between endpoints
+            with self.pool.submit(lambda client: self._submit(client, file_content)) as (client, token):
+                analyze_result = self._wait_for_result(client, token)
             
             # Build PREAP format
             source_info = {
@@ -57,20 +65,136 @@ class InvoiceProcessor:
                 "document_type": "invoice",
             }
             
+            if self.result_store and output:
+                try:
+                    self.result_store.save(output, analyze_result, source_info, content_key(file_content))
+                except Exception as store_error:
+                    print(f"Failed to record analysis result: {store_error}")
+            
             preap_data = self.preap_builder.build_from_di_result(analyze_result, source_info)
+            if output:
+                preap_data["preap_metadata"].update(output.get("metadata") or {})
             return preap_data, None
             
         except Exception as e:
             print(f"Error processing {file_path.name}: {str(e)}")
             return None, str(e)
+    
+    def _submit(self, client: DocumentIntelligenceClient, file_content: bytes) -> str:
+        """Start prebuilt-invoice analysis on one endpoint and return its continuation token
+
+        Only the initial request is sent here, with the pool's submit retries;
+        polling happens in _wait_for_result with the client's default retries.
+        """
+        poller = client.begin_analyze_document(
+            "prebuilt-invoice",
+            body=file_content,
+            content_type="application/octet-stream",
+            polling=False,
+            retry_total=self.pool.submit_retry_total
+        )
+        return poller.continuation_token()
+    
+    def _wait_for_result(self, client: DocumentIntelligenceClient, token: str,
+                         poll_attempts: int = 3) -> AnalyzeResult:
+        """Poll an analysis, resuming on the same endpoint after transient errors"""
+        for attempt in range(1, poll_attempts + 1):
+            # Resuming from the token never resubmits (and re-bills) the document
+            poller = self._resume(client, token)
+            try:
+                # Show progress for long-running operations
+                while not poller.done():
+                    print(" Still processing...")
+                    time.sleep(2)
+                return poller.result()
+            except Exception as e:
+                if attempt == poll_attempts or not self.pool.is_transient(e):
+                    raise
+                print(f" Polling failed, resuming: {e}")
+                time.sleep(2)
+    
+    def _resume(self, client: DocumentIntelligenceClient, token: str) -> LROPoller:
+        # body is required by the signature but ignored when resuming from a token
+        return client.begin_analyze_document("prebuilt-invoice", None, continuation_token=token)
+
+
+class InvoiceApiClient:
+    """Submits backfill work to the API server's scheduler instead of calling the service directly
+
+    Work sent this way is queued behind interactive uploads on the server, so
+    backfills only use the quota the UI leaves over.
+    """
+    
+    def __init__(self, base_url: str, priority: str = "batch", submitter: str = "batch",
+                 timeout: float = 900, max_attempts: int = 20):
+        self.base_url = base_url.rstrip("/")
+        self.priority = priority
+        self.submitter = submitter
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.session = requests.Session()
+    
+    def process_invoice(self, file_path: Path,
+                        output: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """Analyze a file through the server, backing off while it is at capacity"""
+        key = output["key"] if output else file_path.stem
+        
+        for _ in range(self.max_attempts):
+            try:
+                with open(file_path, "rb") as f:
+                    response = self.session.post(
+                        f"{self.base_url}/analyze-batch",
+                        files={"file": (file_path.name, f, "application/pdf")},
+                        data={"key": key, "priority": self.priority, "submitter": self.submitter},
+                        timeout=self.timeout
+                    )
+            except requests.RequestException as e:
+                return None, f"API request failed: {e}"
+            
+            if response.status_code in (429, 503):
+                retry_after = response.headers.get("Retry-After", "5")
+                delay = int(retry_after) if retry_after.isdigit() else 5
+                print(f" Server busy, retrying in {delay}s")
+                time.sleep(delay)
+                continue
+            
+            if response.ok:
+                return response.json()["data"], None
+            try:
+                return None, response.json().get("detail", response.text)
+            except ValueError:
+                return None, response.text
+        
+        return None, "Server stayed at capacity, giving up"
 
 
 class InvoiceBatchProcessor:
     """Batch processor for multiple invoice files"""
     
-    def __init__(self, processor: InvoiceProcessor, output_dir: Path):
+    def __init__(self, processor: Union[InvoiceProcessor, InvoiceApiClient], output_dir: Path,
+                 archive_after_days: Optional[float] = None,
+                 search_index: Optional[SearchIndex] = None, concurrency: int = 1):
+        # Only the server can order backfills against interactive uploads, so
+        # parallel submissions are limited to work that goes through it
+        if concurrency > 1 and not isinstance(processor, InvoiceApiClient):
+            raise ValueError("Concurrent batch processing requires an InvoiceApiClient")
         self.processor = processor
+        self.preap_builder = PreapBuilder()
         self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.search_index = search_index
+        self.storage = StorageTier(
+            output_dir,
+            key_from_name=key_from_stem,
+            max_age_seconds=archive_after_days * 86400 if archive_after_days is not None else None,
+            on_evict=EVICT_ARCHIVE,
+            archive=ArchiveStore(output_dir / "archive"),
+            on_remove=partial(search_index.remove_documents, TIER_PREAP_OUTPUT) if search_index else None
+        )
+        # Results written before sharding would otherwise never be found by age or size budgets
+        moved = self.storage.migrate_flat_files("*.json", exclude=SUMMARY_FILES)
+        if moved:
+            print(f"Migrated {moved} files into sharded storage")
     
     def process_batch(self, input_dir: Path) -> Dict[str, Any]:
         """Process all PDF files in input directory"""
@@ -90,9 +214,12 @@ class InvoiceBatchProcessor:
             "processed_files": []
         }
         
+        executor = ThreadPoolExecutor(max_workers=self.concurrency) if self.concurrency > 1 else None
+        pending = self._submit_all(executor, pdf_files) if executor else {}
+        
         for i, pdf_file in enumerate(pdf_files, 1):
             print(f"\n[{i}/{len(pdf_files)}] Processing: {pdf_file.name}")
-            file_result = self._process_single_file(pdf_file)
+            file_result = self._process_single_file(pdf_file, pending.get(pdf_file))
             results["processed_files"].append(file_result)
             
             if file_result["status"] == "success":
@@ -102,16 +229,30 @@ class InvoiceBatchProcessor:
             else:
                 results["skipped"] += 1
         
+        if executor:
+            executor.shutdown()
         self._save_summary(results)
+        self.storage.enforce_budget()
         return results
     
-    def _process_single_file(self, pdf_file: Path) -> Dict[str, Any]:
+    def _submit_all(self, executor: ThreadPoolExecutor, pdf_files) -> Dict[Path, Future]:
+        """Start every file that still needs processing; the server schedules the actual analyses"""
+        return {
+            pdf_file: executor.submit(self.processor.process_invoice, pdf_file, self._output_for(pdf_file))
+            for pdf_file in pdf_files
+            if not self.storage.exists(pdf_file.stem)
+        }
+    
+    def _output_for(self, pdf_file: Path) -> Dict[str, Any]:
+        return output_target(TIER_PREAP_OUTPUT, pdf_file.stem, f"{pdf_file.stem}.json")
+    
+    def _process_single_file(self, pdf_file: Path, pending: Optional[Future] = None) -> Dict[str, Any]:
         """Process a single PDF file"""
         json_filename = f"{pdf_file.stem}.json"
-        json_path = self.output_dir / json_filename
+        json_path = self.storage.path_for(pdf_file.stem, json_filename)
         
-        # Skip if already processed
-        if json_path.exists():
+        # Skip if already processed (including results compacted into the archive)
+        if self.storage.exists(pdf_file.stem):
             print(f"JSON already exists, skipping: {json_filename}")
             return {
                 "file": pdf_file.name,
@@ -121,10 +262,14 @@ class InvoiceBatchProcessor:
             }
         
         # Process invoice
-        preap_data, error = self.processor.process_invoice(pdf_file)
+        if pending is not None:
+            preap_data, error = pending.result()
+        else:
+            preap_data, error = self.processor.process_invoice(pdf_file, self._output_for(pdf_file))
         
         if preap_data:
-            if self.processor.preap_builder.save_to_file(preap_data, json_path):
+            if self.preap_builder.save_to_file(preap_data, json_path):
+                self._index_result(pdf_file.stem, preap_data, json_filename)
                 vendor = self._get_vendor_name(preap_data)
                 print(f" Successfully processed and saved: {json_filename}")
                 print(f" Vendor: {vendor}")
@@ -149,6 +294,15 @@ class InvoiceBatchProcessor:
                 "error": error
             }
     
+    def _index_result(self, key: str, preap_data: Dict[str, Any], json_filename: str):
+        """Add a saved result to the search index, if one is configured"""
+        if not self.search_index:
+            return
+        try:
+            self.search_index.add_document(TIER_PREAP_OUTPUT, key, preap_data, json_filename)
+        except Exception as e:
+            print(f"Failed to index {json_filename}: {e}")
+    
     def _get_vendor_name(self, preap_data: Dict[str, Any]) -> str:
         """Extract vendor name from PREAP data"""
         try:
@@ -209,8 +363,11 @@ def main():
     input_folder = Path("Finance_AP/AP Invoice Samples")
     output_folder = Path("preap_output")
     
+    # Backfills go through the API server when it is configured, so they queue behind uploads
+    api_url = os.getenv("INVOICE_API_URL")
+    
     # Validate configuration
-    if not validate_environment():
+    if not api_url and not validate_environment():
         return
     
     if not validate_paths(input_folder, output_folder):
@@ -218,13 +375,31 @@ def main():
     
     # Initialize processors
     try:
-        endpoint = os.getenv("DOCUMENTINTELLIGENCE_ENDPOINT")
-        key = os.getenv("DOCUMENTINTELLIGENCE_API_KEY")
-        
-        invoice_processor = InvoiceProcessor(endpoint, key)
-        batch_processor = InvoiceBatchProcessor(invoice_processor, output_folder)
+        if api_url:
+            invoice_processor = InvoiceApiClient(api_url)
+            concurrency = int(os.getenv("BATCH_CONCURRENCY", "2"))
+            print(f"Submitting batch work to API server: {api_url}")
+        else:
+            endpoint = os.getenv("DOCUMENTINTELLIGENCE_ENDPOINT")
+            key = os.getenv("DOCUMENTINTELLIGENCE_API_KEY")
+            
+            result_store_dir = os.getenv("RESULT_STORE_DIR")
+            result_store = ResultStore(Path(result_store_dir)) if result_store_dir else None
+            
+            # Without the server nothing coordinates quota use, so files run one at a time
+            invoice_processor = InvoiceProcessor(endpoint, key, result_store=result_store)
+            concurrency = 1
+            print("Azure Document Intelligence client initialized successfully")
         
-        print("Azure Document Intelligence client initialized successfully")
+        archive_after = os.getenv("PREAP_ARCHIVE_AFTER_DAYS")
+        batch_processor = InvoiceBatchProcessor(
+            invoice_processor,
+            output_folder,
+            archive_after_days=float(archive_after) if archive_after else None,
+            # Same index the API serves /search from
+            search_index=SearchIndex(Path(os.getenv("SEARCH_INDEX_PATH", "search_index/index.db"))),
+            concurrency=concurrency
+        )
         
     except Exception as e:
         print(f"Failed to initialize Azure client: {e}")
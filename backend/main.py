@@ -1,17 +1,30 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 import os
+import asyncio
+import shutil
 import tempfile
+import threading
 import uuid
+from functools import partial
 from pathlib import Path
+from typing import Optional
 from dotenv import load_dotenv
 import uvicorn
 import json
 
 # Import from your existing invoice_ex.py
 from invoice_ex import InvoiceProcessor
+from analysis_scheduler import (
+    AnalysisScheduler, DeadlineExceededError, PRIORITY_INTERACTIVE, PRIORITY_BATCH, PRIORITY_REPROCESS
+)
+from storage_manager import StorageManager
+from result_store import ResultStore, output_target, TIER_PROCESSED_JSON, TIER_PREAP_OUTPUT
+from search_index import SearchIndex
+from admission_control import AdmissionController, AdmissionMiddleware
 
 # Load environment variables
 load_dotenv()
@@ -26,13 +39,53 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 JSON_OUTPUT_DIR = Path("processed_json")
 JSON_OUTPUT_DIR.mkdir(exist_ok=True)
 
-# CORS middleware
+# Batch PREAP output, also covered by the search index
+PREAP_OUTPUT_DIR = Path(os.getenv("PREAP_OUTPUT_DIR", "preap_output"))
+
+# Full-text index over OCR content, updated as results are saved
+search_index = SearchIndex(Path(os.getenv("SEARCH_INDEX_PATH", "search_index/index.db")))
+
+# Sharded storage with size/age budgets and JSON archival; dropped results leave the index too
+storage = StorageManager.from_env(
+    UPLOAD_DIR,
+    JSON_OUTPUT_DIR,
+    on_json_removed=partial(search_index.remove_documents, TIER_PROCESSED_JSON)
+)
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10MB limit
+# Room for multipart boundaries and the small form fields sent alongside the file
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES + 64 * 1024
+
+# Bounded budget for uploads in flight, applied before the request body is read
+admission = AdmissionController.from_env()
+
+# Backfill submissions get their own budget and no wait queue, so they never crowd out uploads
+batch_admission = AdmissionController(
+    max_in_flight=int(os.getenv("ADMISSION_BATCH_MAX_IN_FLIGHT", "8")),
+    max_queued=0,
+    per_client_limit=int(os.getenv("ADMISSION_BATCH_PER_CLIENT_LIMIT", "8"))
+)
+
+ADMISSION_BY_PATH = {
+    "/upload-invoice": admission,
+    "/analyze-batch": batch_admission
+}
+
+# Admission and the request size cap run before Starlette reads or parses the body
+app.add_middleware(
+    AdmissionMiddleware,
+    controllers=ADMISSION_BY_PATH,
+    max_request_bytes=MAX_REQUEST_BYTES
+)
+
+# CORS middleware (added after admission so rejections still carry CORS headers)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://localhost:5173"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
 # Initialize the invoice processor
@@ -42,10 +95,58 @@ key = os.getenv("DOCUMENTINTELLIGENCE_API_KEY")
 if not endpoint or not key:
     raise ValueError("Missing Azure Document Intelligence credentials")
 
-invoice_processor = InvoiceProcessor(endpoint, key)
+# Optionally record raw analysis results for offline rebuilds
+result_store_dir = os.getenv("RESULT_STORE_DIR")
+result_store = ResultStore(Path(result_store_dir)) if result_store_dir else None
+
+invoice_processor = InvoiceProcessor(endpoint, key, result_store=result_store)
+
+# All analysis goes through the scheduler so interactive uploads run ahead of backfills
+scheduler = AnalysisScheduler.from_env(invoice_processor)
+
+@app.on_event("startup")
+async def start_storage_maintenance():
+    """Shard legacy files and start periodic budget enforcement"""
+    storage.migrate()
+    storage.start()
+    scheduler.start()
+    if search_index.needs_rebuild:
+        # Runs after migration so every result is in its shard; searches are partial until it finishes
+        threading.Thread(
+            target=search_index.rebuild,
+            args=({TIER_PROCESSED_JSON: JSON_OUTPUT_DIR, TIER_PREAP_OUTPUT: PREAP_OUTPUT_DIR},),
+            name="search-index-rebuild",
+            daemon=True
+        ).start()
+
+@app.on_event("shutdown")
+async def stop_storage_maintenance():
+    storage.stop()
+    scheduler.stop()
+
+BATCH_PRIORITIES = {"batch": PRIORITY_BATCH, "reprocess": PRIORITY_REPROCESS}
+
+async def _save_upload(file: UploadFile, path: Path) -> int:
+    """Stream an uploaded file to disk in chunks, enforcing the size limit"""
+    file_size = 0
+    with open(path, "wb") as buffer:
+        while chunk := await file.read(8192):  # 8KB chunks
+            file_size += len(chunk)
+            if file_size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=400, detail="File size exceeds 10MB limit")
+            buffer.write(chunk)
+    return file_size
+
+def _archived_response(content: bytes, filename: str, media_type: str) -> Response:
+    """Serve a file read from an archive bundle"""
+    return Response(
+        content=content,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 @app.post("/upload-invoice")
-async def upload_invoice(file: UploadFile = File(...)):
+async def upload_invoice(request: Request, file: UploadFile = File(...)):
     """
     Upload and process an invoice PDF file
     """
@@ -58,39 +159,38 @@ async def upload_invoice(file: UploadFile = File(...)):
         file_id = str(uuid.uuid4())
         original_filename = file.filename
         saved_filename = f"{file_id}_{original_filename}"
-        saved_path = UPLOAD_DIR / saved_filename
-        
-        file_size = 0
+        saved_path = storage.uploads.path_for(file_id, saved_filename)
         
         try:
             # Save the uploaded file
-            with open(saved_path, "wb") as buffer:
-                while chunk := await file.read(8192):  # 8KB chunks
-                    file_size += len(chunk)
-                    if file_size > 10 * 1024 * 1024:  # 10MB limit
-                        raise HTTPException(status_code=400, detail="File size exceeds 10MB limit")
-                    buffer.write(chunk)
+            file_size = await _save_upload(file, saved_path)
             
-            # Process the invoice using your existing processor
-            preap_data, error = invoice_processor.process_invoice(saved_path)
-            
-            if preap_data:
-                # Add file info to the response
-                preap_data["preap_metadata"]["uploaded_file"] = {
+            # File info is added to preap_metadata and recorded for replay
+            json_filename = f"{file_id}_{original_filename}.json"
+            output = output_target(TIER_PROCESSED_JSON, file_id, json_filename, {
+                "uploaded_file": {
                     "file_id": file_id,
                     "original_filename": original_filename,
                     "saved_filename": saved_filename,
                     "file_size": file_size
                 }
-                
+            })
+            
+            # Process the invoice through the scheduler without blocking the event loop
+            client_id = request.client.host if request.client else "unknown"
+            preap_data, error = await asyncio.wrap_future(
+                scheduler.submit(saved_path, priority=PRIORITY_INTERACTIVE, submitter=client_id, output=output)
+            )
+            
+            if preap_data:
                 # Save JSON locally
-                json_filename = f"{file_id}_{original_filename}.json"
-                json_path = JSON_OUTPUT_DIR / json_filename
+                json_path = storage.processed_json.path_for(file_id, json_filename)
                 
                 try:
                     with open(json_path, 'w', encoding='utf-8') as f:
                         json.dump(preap_data, f, indent=2, ensure_ascii=False, default=str)
                     print(f"JSON saved locally: {json_path}")
+                    await run_in_threadpool(search_index.add_document, TIER_PROCESSED_JSON, file_id, preap_data, json_filename)
                 except Exception as json_error:
                     print(f"Failed to save JSON locally: {json_error}")
                 
@@ -120,60 +220,129 @@ async def upload_invoice(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
 
+@app.post("/analyze-batch")
+async def analyze_batch(
+    request: Request,
+    file: UploadFile = File(...),
+    key: str = Form(...),
+    priority: str = Form("batch"),
+    submitter: Optional[str] = Form(None),
+    deadline_seconds: Optional[float] = Form(None)
+):
+    """
+    Analyze a backfill PDF through the shared scheduler and return its PREAP data
+    """
+    # The key names the output and record files, so it must be a plain file stem
+    if not key or key != Path(key).name or key.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid key")
+    if priority not in BATCH_PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Priority must be one of: {', '.join(BATCH_PRIORITIES)}")
+    
+    # Backfill PDFs are not kept; the caller stores the returned result
+    work_dir = Path(tempfile.mkdtemp(prefix="batch_"))
+    try:
+        file_path = work_dir / Path(file.filename or f"{key}.pdf").name
+        await _save_upload(file, file_path)
+        
+        client_id = submitter or (request.client.host if request.client else "unknown")
+        output = output_target(TIER_PREAP_OUTPUT, key, f"{key}.json")
+        preap_data, error = await asyncio.wrap_future(scheduler.submit(
+            file_path,
+            priority=BATCH_PRIORITIES[priority],
+            submitter=client_id,
+            deadline_seconds=deadline_seconds,
+            output=output
+        ))
+        if not preap_data:
+            raise HTTPException(status_code=500, detail=error or "Failed to process invoice")
+        
+        return {"success": True, "data": preap_data, "key": key}
+    except DeadlineExceededError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+# Storage reads may hit the archive, so these run in the threadpool rather than on the event loop
 @app.get("/pdf/{file_id}")
-async def get_pdf(file_id: str):
+def get_pdf(file_id: str):
     """
     Get uploaded PDF file by ID
     """
     try:
         # Find the file by ID
-        pdf_files = list(UPLOAD_DIR.glob(f"{file_id}_*"))
-        if not pdf_files:
+        pdf_path = storage.uploads.find(file_id)
+        if pdf_path:
+            storage.uploads.touch(pdf_path)
+            return FileResponse(
+                path=pdf_path,
+                filename=pdf_path.name.split('_', 1)[1],  # Remove the UUID prefix
+                media_type='application/pdf'
+            )
+        
+        archived = storage.uploads.read(file_id)
+        if not archived:
             raise HTTPException(status_code=404, detail="PDF file not found")
         
-        pdf_path = pdf_files[0]
-        return FileResponse(
-            path=pdf_path,
-            filename=pdf_path.name.split('_', 1)[1],  # Remove the UUID prefix
-            media_type='application/pdf'
-        )
+        name, content = archived
+        return _archived_response(content, name.split('_', 1)[1], 'application/pdf')
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving PDF: {str(e)}")
 
 @app.get("/download-json/{file_id}")
-async def download_json(file_id: str):
+def download_json(file_id: str):
     """
     Download processed JSON file by file ID
     """
     try:
-        # Find the JSON file by ID
-        json_files = list(JSON_OUTPUT_DIR.glob(f"{file_id}_*"))
-        if not json_files:
+        # Find the JSON file by ID, falling back to the archive
+        json_path = storage.processed_json.find(file_id)
+        if json_path:
+            return FileResponse(
+                path=json_path,
+                filename=json_path.name,
+                media_type='application/json'
+            )
+        
+        archived = storage.processed_json.read(file_id)
+        if not archived:
             raise HTTPException(status_code=404, detail="JSON file not found")
         
-        json_path = json_files[0]
-        return FileResponse(
-            path=json_path,
-            filename=json_path.name,
-            media_type='application/json'
-        )
+        name, content = archived
+        return _archived_response(content, name, 'application/json')
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving JSON: {str(e)}")
 
 @app.get("/list-json")
-async def list_json_files():
+def list_json_files():
     """
     List all processed JSON files
     """
     try:
         json_files = []
-        for json_path in JSON_OUTPUT_DIR.glob("*.json"):
+        for entry in storage.processed_json.iter_files():
+            if not entry.name.endswith('.json'):
+                continue
+            stat = entry.stat()
+            json_files.append({
+                "filename": entry.name,
+                "file_id": entry.name.split('_')[0],
+                "original_filename": '_'.join(entry.name.split('_')[1:]).replace('.json', ''),
+                "size": stat.st_size,
+                "modified": stat.st_mtime
+            })
+        
+        for file_id, archived in storage.processed_json.archive.entries().items():
             json_files.append({
-                "filename": json_path.name,
-                "file_id": json_path.name.split('_')[0],
-                "original_filename": '_'.join(json_path.name.split('_')[1:]).replace('.json', ''),
-                "size": json_path.stat().st_size,
-                "modified": json_path.stat().st_mtime
+                "filename": archived["member"],
+                "file_id": file_id,
+                "original_filename": '_'.join(archived["member"].split('_')[1:]).replace('.json', ''),
+                "size": archived["size"],
+                "modified": archived["modified"],
+                "archived": True
             })
         
         return {
@@ -184,10 +353,33 @@ async def list_json_files():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listing JSON files: {str(e)}")
 
+@app.get("/search")
+async def search_invoices(
+    q: str = Query(..., min_length=1),
+    prefix: bool = False,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100)
+):
+    """
+    Search the OCR content of processed invoices
+    """
+    try:
+        results = await run_in_threadpool(search_index.search, q, prefix=prefix, page=page, page_size=page_size)
+        return {"success": True, **results}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching invoices: {str(e)}")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "service": "Invoice Processing API"}
+    return {
+        "status": "healthy",
+        "service": "Invoice Processing API",
+        "endpoints": invoice_processor.pool.get_stats(),
+        "scheduler": scheduler.get_stats(),
+        "admission": admission.get_stats(),
+        "batch_admission": batch_admission.get_stats()
+    }
 
 @app.get("/")
 async def root():
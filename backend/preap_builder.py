@@ -6,14 +6,15 @@ import uuid
 import json
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 from azure.ai.documentintelligence.models import AnalyzeResult
 
 class PreapBuilder:
     """Builds PREAP format from Document Intelligence results"""
     
-    def __init__(self):
+    def __init__(self, include_table_geometry: bool = False):
         self.preap_version = "1.0"
+        self.include_table_geometry = include_table_geometry
         self._field_mappings = self._get_all_field_mappings()
         self._item_field_mappings = self._get_all_item_field_mappings()
     
@@ -150,23 +151,28 @@ class PreapBuilder:
     
     def _extract_invoice_data(self, invoices: AnalyzeResult) -> Dict[str, Any]:
         """Extract structured invoice data"""
-        if not invoices.documents:
-            return {"documents": []}
+        documents = invoices.documents or []
+        tables_by_document, unassigned_tables = self._assign_tables(
+            documents, getattr(invoices, 'tables', None) or []
+        )
         
-        return {
+        extracted_data = {
             "documents": [
-                self._extract_single_invoice(invoice, idx)
-                for idx, invoice in enumerate(invoices.documents)
+                self._extract_single_invoice(invoice, idx, tables_by_document[idx])
+                for idx, invoice in enumerate(documents)
             ]
         }
+        if unassigned_tables:
+            extracted_data["unassigned_tables"] = unassigned_tables
+        return extracted_data
     
-    def _extract_single_invoice(self, invoice, index: int) -> Dict[str, Any]:
+    def _extract_single_invoice(self, invoice, index: int, tables: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Extract data from a single invoice document"""
         invoice_data = {
             "document_number": index + 1,
             "fields": self._extract_fields(invoice.fields),
             "items": self._extract_items(invoice.fields.get("Items")),
-            "tables": self._extract_tables(invoice)
+            "tables": tables
         }
         
         # Remove empty sections
@@ -243,33 +249,123 @@ class PreapBuilder:
         
         return items
     
-    def _extract_tables(self, invoice) -> List[Dict[str, Any]]:
-        """Extract table data from invoice"""
-        tables = []
+    def _assign_tables(self, documents, tables) -> Tuple[List[List[Dict[str, Any]]], List[Dict[str, Any]]]:
+        """Assign result-level tables to documents by span overlap, falling back to page"""
+        tables_by_document = [[] for _ in documents]
+        unassigned = []
+        
+        document_spans = [self._span_ranges(doc) for doc in documents]
+        document_pages = [self._page_numbers(doc) for doc in documents]
+        
+        for table_idx, table in enumerate(tables):
+            table_data = self._extract_table(table, table_idx)
+            table_spans = self._span_ranges(table)
+            table_pages = set(table_data["page_numbers"])
+            
+            owner = next(
+                (idx for idx, spans in enumerate(document_spans) if self._overlaps(spans, table_spans)),
+                None
+            )
+            if owner is None:
+                owner = next(
+                    (idx for idx, pages in enumerate(document_pages) if pages & table_pages),
+                    None
+                )
+            if owner is None and len(documents) == 1:
+                owner = 0
+            
+            if owner is None:
+                unassigned.append(table_data)
+            else:
+                tables_by_document[owner].append(table_data)
+        
+        # Number tables per document in reading order
+        for document_tables in tables_by_document:
+            for number, table_data in enumerate(document_tables, 1):
+                table_data["table_number"] = number
+        
+        return tables_by_document, unassigned
+    
+    def _extract_table(self, table, index: int) -> Dict[str, Any]:
+        """Convert a table into a row-major grid with header rows and merged-cell spans"""
+        row_count, column_count = table.row_count, table.column_count
+        rows: List[List[Any]] = [[None] * column_count for _ in range(row_count)]
+        header_cells = [[False] * column_count for _ in range(row_count)]
+        merges = []
+        geometry = []
+        
+        for cell in table.cells:
+            row, col = cell.row_index, cell.column_index
+            rows[row][col] = cell.content
+            row_span = getattr(cell, 'row_span', None) or 1
+            column_span = getattr(cell, 'column_span', None) or 1
+            
+            if row_span > 1 or column_span > 1:
+                merges.append([row, col, row_span, column_span])
+            # The stub head is the top-left header cell above the row-header column
+            if getattr(cell, 'kind', None) in ("columnHeader", "stubHead"):
+                for r in range(row, min(row + row_span, row_count)):
+                    for c in range(col, min(col + column_span, column_count)):
+                        header_cells[r][c] = True
+            if self.include_table_geometry and cell.bounding_regions:
+                region = cell.bounding_regions[0]
+                geometry.append([row, col, region.page_number, region.polygon])
         
-        # Extract from document level tables if available
-        if hasattr(invoice, 'tables') and invoice.tables:
-            for table_idx, table in enumerate(invoice.tables):
-                table_data = {
-                    "table_number": table_idx + 1,
-                    "row_count": table.row_count,
-                    "column_count": table.column_count,
-                    "cells": []
-                }
-                
-                for cell in table.cells:
-                    cell_data = {
-                        "row_index": cell.row_index,
-                        "column_index": cell.column_index,
-                        "content": cell.content,
-                        "bounding_regions": getattr(cell, 'bounding_regions', None),
-                        "spans": getattr(cell, 'spans', None)
-                    }
-                    table_data["cells"].append(cell_data)
-                
-                tables.append(table_data)
+        # Header rows are the leading rows made up entirely of column header cells
+        header_rows = 0
+        while header_rows < row_count and all(header_cells[header_rows]):
+            header_rows += 1
         
-        return tables
+        table_data = {
+            "table_number": index + 1,
+            "row_count": row_count,
+            "column_count": column_count,
+            "page_numbers": sorted({
+                region.page_number for region in (getattr(table, 'bounding_regions', None) or [])
+            }),
+            "header_rows": header_rows,
+            "columns": self._column_names(rows, header_rows, merges) if header_rows else None,
+            "rows": rows
+        }
+        if merges:
+            table_data["merges"] = merges
+        if self.include_table_geometry:
+            table_data["geometry"] = geometry
+        
+        return {k: v for k, v in table_data.items() if v is not None}
+    
+    def _column_names(self, rows: List[List[Any]], header_rows: int, merges: List[List[int]]) -> List[str]:
+        """Join multi-row headers per column, spreading merged header text across its columns"""
+        header = [list(row) for row in rows[:header_rows]]
+        for row, col, row_span, column_span in merges:
+            if row >= header_rows:
+                continue
+            for r in range(row, min(row + row_span, header_rows)):
+                for c in range(col, min(col + column_span, len(header[r]))):
+                    header[r][c] = rows[row][col]
+        
+        columns = []
+        for col in range(len(rows[0]) if rows else 0):
+            parts = []
+            for r in range(header_rows):
+                text = header[r][col]
+                if text and (not parts or parts[-1] != text):
+                    parts.append(text)
+            columns.append(" ".join(parts))
+        return columns
+    
+    def _span_ranges(self, obj) -> List[Tuple[int, int]]:
+        return [
+            (span.offset, span.offset + span.length)
+            for span in (getattr(obj, 'spans', None) or [])
+        ]
+    
+    def _page_numbers(self, obj) -> set:
+        return {region.page_number for region in (getattr(obj, 'bounding_regions', None) or [])}
+    
+    def _overlaps(self, spans: List[Tuple[int, int]], other: List[Tuple[int, int]]) -> bool:
+        return any(start < other_end and other_start < end
+                   for start, end in spans for other_start, other_end in other)
     
     def save_to_file(self, preap_data: Dict[str, Any], file_path: Path) -> bool:
         """Save PREAP data to JSON file"""
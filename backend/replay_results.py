@@ -0,0 +1,117 @@
+"""
+Rebuild PREAP output from recorded Document Intelligence results without calling the service
+"""
+
+import os
+import time
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+from preap_builder import PreapBuilder
+from result_store import ResultStore, TIER_PROCESSED_JSON, TIER_PREAP_OUTPUT
+from storage_manager import StorageTier, key_before_underscore, key_from_stem
+
+# Per-worker state, created once by _init_worker
+_builder: Optional[PreapBuilder] = None
+_tiers: Dict[str, StorageTier] = {}
+
+
+def _init_worker(tier_dirs: Dict[str, str]):
+    global _builder, _tiers
+    _builder = PreapBuilder()
+    # Same layout and key functions the API and batch processor write with
+    _tiers = {
+        TIER_PROCESSED_JSON: StorageTier(Path(tier_dirs[TIER_PROCESSED_JSON]), key_from_name=key_before_underscore),
+        TIER_PREAP_OUTPUT: StorageTier(Path(tier_dirs[TIER_PREAP_OUTPUT]), key_from_name=key_from_stem)
+    }
+
+
+def _replay_one(record_path: str) -> Dict[str, Any]:
+    """Rebuild and overwrite the served PREAP JSON for one recorded result"""
+    try:
+        record = ResultStore.load(Path(record_path))
+        output = record.get("output")
+        if not output or output.get("tier") not in _tiers:
+            return {"record": record_path, "status": "failed", "error": "Record has no known output target"}
+
+        preap_data = _builder.build_from_di_result(record["analyze_result"], record["source"])
+        preap_data["preap_metadata"].update(output.get("metadata") or {})
+        preap_data["preap_metadata"]["replayed_from"] = record["key"]
+
+        # Overwrite the file currently served for this key, wherever it lives
+        tier = _tiers[output["tier"]]
+        json_path = tier.find(output["key"]) or tier.path_for(output["key"], output["filename"])
+        if not _builder.save_to_file(preap_data, json_path):
+            return {"record": record_path, "status": "failed", "error": "Failed to save JSON file"}
+        return {"record": record_path, "status": "success", "json_output": json_path.name}
+    except Exception as e:
+        return {"record": record_path, "status": "failed", "error": str(e)}
+
+
+def replay(store_dir: Path, json_dir: Path, output_dir: Path, workers: Optional[int] = None) -> Dict[str, Any]:
+    """Rebuild the PREAP output of every recorded result in parallel"""
+    store = ResultStore(store_dir)
+    record_paths = [str(path) for path in store.iter_paths()]
+
+    results = {
+        "total_records": len(record_paths),
+        "successful": 0,
+        "failed": 0,
+        "failures": []
+    }
+    if not record_paths:
+        print(f"No recorded results found in {store_dir}")
+        return results
+
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(record_paths) // (workers * 16))
+    print(f"Replaying {len(record_paths)} recorded results with {workers} workers")
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=({TIER_PROCESSED_JSON: str(json_dir),
+                                        TIER_PREAP_OUTPUT: str(output_dir)},)) as executor:
+        for i, result in enumerate(executor.map(_replay_one, record_paths, chunksize=chunksize), 1):
+            if result["status"] == "success":
+                results["successful"] += 1
+            else:
+                results["failed"] += 1
+                results["failures"].append(result)
+            if i % 1000 == 0:
+                print(f"[{i}/{len(record_paths)}] replayed")
+
+    return results
+
+
+def main():
+    """Main execution function"""
+    parser = argparse.ArgumentParser(description="Rebuild PREAP output from recorded analysis results")
+    parser.add_argument("--store", default=os.getenv("RESULT_STORE_DIR", "result_store"),
+                        help="Directory of recorded results")
+    parser.add_argument("--json-dir", default="processed_json", help="API processed JSON directory")
+    parser.add_argument("--output", default="preap_output", help="Batch PREAP output directory")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    results = replay(Path(args.store), Path(args.json_dir), Path(args.output), args.workers)
+    total_time = time.time() - start_time
+
+    summary_file = Path(args.output) / "replay_summary.json"
+    try:
+        with open(summary_file, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    except Exception as e:
+        print(f"Failed to save summary: {e}")
+
+    print("\n=== REPLAY SUMMARY ===")
+    print(f"Total records: {results['total_records']}")
+    print(f"Successful: {results['successful']}")
+    print(f"Failed: {results['failed']}")
+    print(f"Total time: {total_time:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Compressed store of raw Document Intelligence results for replaying PREAP builds
+"""
+
+import gzip
+import json
+import hashlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Any, Iterator, Optional
+
+from azure.ai.documentintelligence.models import AnalyzeResult
+
+from storage_manager import StorageTier
+
+RECORD_SUFFIX = ".json.gz"
+
+# Storage tiers a PREAP result can be served from
+TIER_PROCESSED_JSON = "processed_json"
+TIER_PREAP_OUTPUT = "preap_output"
+
+
+def content_key(file_content: bytes) -> str:
+    """Stable hash of a document, independent of its file name"""
+    return hashlib.sha256(file_content).hexdigest()
+
+
+def output_target(tier: str, key: str, filename: str, metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Describe the served JSON file a result is built into
+
+    metadata is merged into preap_metadata, both when the result is first
+    built and when it is replayed.
+    """
+    return {"tier": tier, "key": key, "filename": filename, "metadata": metadata or {}}
+
+
+def record_key(output: Dict[str, Any]) -> str:
+    """One record per served output file, so identical PDFs uploaded twice keep both outputs"""
+    return f"{output['tier']}--{output['key']}"
+
+
+def _key_from_record_name(name: str) -> str:
+    return name[:-len(RECORD_SUFFIX)] if name.endswith(RECORD_SUFFIX) else name
+
+
+class ResultStore:
+    """Records AnalyzeResult payloads keyed by the output file they produce"""
+
+    def __init__(self, root: Path, compress_level: int = 6):
+        self.root = root
+        self.compress_level = compress_level
+        self.tier = StorageTier(root, key_from_name=_key_from_record_name)
+
+    def save(self, output: Dict[str, Any], analyze_result, source_info: Dict[str, Any],
+             file_hash: Optional[str] = None) -> Path:
+        """Persist the raw result with the source info and output target used to build it"""
+        raw = analyze_result.as_dict() if hasattr(analyze_result, 'as_dict') else dict(analyze_result)
+        key = record_key(output)
+        record = {
+            "key": key,
+            "content_hash": file_hash,
+            "recorded_at": datetime.now(timezone.utc).isoformat(),
+            "source": source_info,
+            "output": output,
+            "analyze_result": raw
+        }
+
+        path = self.tier.path_for(key, f"{key}{RECORD_SUFFIX}")
+        tmp_path = path.with_name(path.name + ".tmp")
+        with gzip.open(tmp_path, 'wt', encoding='utf-8', compresslevel=self.compress_level) as f:
+            json.dump(record, f, ensure_ascii=False, default=str)
+        tmp_path.replace(path)
+        return path
+
+    def has(self, output: Dict[str, Any]) -> bool:
+        return self.tier.find(record_key(output)) is not None
+
+    def iter_paths(self) -> Iterator[Path]:
+        for entry in self.tier.iter_files():
+            if entry.name.endswith(RECORD_SUFFIX):
+                yield Path(entry.path)
+
+    @staticmethod
+    def load(path: Path) -> Dict[str, Any]:
+        """Read a record and rehydrate its AnalyzeResult"""
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            record = json.load(f)
+        record["analyze_result"] = AnalyzeResult(record["analyze_result"])
+        return record
+
+    def get(self, output: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        path = self.tier.find(record_key(output))
+        return self.load(path) if path else None
@@ -0,0 +1,339 @@
+"""
+Full-text search index over the OCR content of processed invoices
+"""
+
+import re
+import json
+import sqlite3
+import argparse
+import threading
+from collections.abc import Mapping
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from result_store import TIER_PROCESSED_JSON, TIER_PREAP_OUTPUT
+from storage_manager import StorageTier, key_before_underscore, key_from_stem
+
+SCHEMA_VERSION = 2
+
+# Documents are matched and ranked as a whole; page rows only supply page numbers and snippets
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_rowid INTEGER PRIMARY KEY,
+    tier TEXT NOT NULL,
+    key TEXT NOT NULL,
+    filename TEXT,
+    indexed_at TEXT,
+    UNIQUE (tier, key)
+);
+CREATE TABLE IF NOT EXISTS pages (
+    rowid INTEGER PRIMARY KEY,
+    doc_rowid INTEGER NOT NULL,
+    page_number INTEGER
+);
+CREATE INDEX IF NOT EXISTS pages_doc_rowid ON pages(doc_rowid);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    content,
+    content='',
+    tokenize='unicode61',
+    prefix='2 3 4'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(
+    content,
+    tokenize='unicode61',
+    prefix='2 3 4'
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_LEGACY_TABLES = ("pages_fts", "documents_fts", "pages", "documents", "meta")
+
+# Key function per tier, matching how each tier names its files
+TIER_KEY_FUNCTIONS: Dict[str, Callable[[str], str]] = {
+    TIER_PROCESSED_JSON: key_before_underscore,
+    TIER_PREAP_OUTPUT: key_from_stem
+}
+
+
+class SearchIndex:
+    """Incremental inverted index (SQLite FTS5) shared by the API and the batch processor
+
+    Each document gets one row in documents_fts, so every query term must
+    occur somewhere in the document, and one row per page in pages_fts for
+    page numbers and snippets. Only the ranked_candidates most recently added
+    matches are scored, which keeps a search fast however many documents
+    match. Reads use a connection per thread and run concurrently under WAL;
+    writes are serialized.
+    """
+
+    def __init__(self, db_path: Path, max_counted_hits: int = 1000, ranked_candidates: int = 1000):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.max_counted_hits = max_counted_hits
+        self.ranked_candidates = ranked_candidates
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        outdated = conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION
+        if outdated:
+            # Earlier layouts cannot be migrated in place, so the index starts empty and is rebuilt
+            with conn:
+                for table in _LEGACY_TABLES:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.executescript(_SCHEMA)
+        if outdated:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('rebuild_pending', '1')")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+        if self.needs_rebuild:
+            print(f"WARNING: search index {db_path} is empty or outdated; searches return incomplete "
+                  f"results until it is rebuilt (the API does this on startup, or run search_index.py)")
+
+    @property
+    def needs_rebuild(self) -> bool:
+        """True until a full rebuild has completed after the index was (re)created"""
+        row = self._connection().execute("SELECT value FROM meta WHERE name = 'rebuild_pending'").fetchone()
+        return row is not None
+
+    def rebuild(self, sources: Dict[str, Path]) -> int:
+        """Index every JSON result of the given tier directories, then clear the rebuild flag"""
+        indexed = 0
+        for tier, directory in sources.items():
+            if directory.is_dir():
+                indexed += index_directory(self, tier, directory)
+        conn = self._connection()
+        with self._write_lock, conn:
+            conn.execute("DELETE FROM meta WHERE name = 'rebuild_pending'")
+        return indexed
+
+    def add_document(self, tier: str, key: str, preap_data: Dict[str, Any], filename: Optional[str] = None):
+        """Index (or re-index) the OCR content of one PREAP result"""
+        analysis = preap_data.get("full_analysis", {})
+        pages = [
+            (page_number, text)
+            for page_number, text in self._split_pages(analysis.get("content") or "", analysis.get("pages") or [])
+            if text.strip()
+        ]
+
+        conn = self._connection()
+        with self._write_lock, conn:
+            doc_rowid = self._delete(conn, tier, key)
+            cursor = conn.execute(
+                "INSERT INTO documents (doc_rowid, tier, key, filename, indexed_at) VALUES (?, ?, ?, ?, ?)",
+                (doc_rowid, tier, key, filename, datetime.now(timezone.utc).isoformat())
+            )
+            doc_rowid = cursor.lastrowid
+            conn.execute(
+                "INSERT INTO documents_fts (rowid, content) VALUES (?, ?)",
+                (doc_rowid, self._document_text(text for _, text in pages))
+            )
+            for page_number, text in pages:
+                page_rowid = conn.execute(
+                    "INSERT INTO pages (doc_rowid, page_number) VALUES (?, ?)", (doc_rowid, page_number)
+                ).lastrowid
+                conn.execute("INSERT INTO pages_fts (rowid, content) VALUES (?, ?)", (page_rowid, text))
+
+    def remove_document(self, tier: str, key: str):
+        self.remove_documents(tier, [key])
+
+    def remove_documents(self, tier: str, keys: List[str]):
+        """Drop results that no longer exist in storage"""
+        conn = self._connection()
+        with self._write_lock, conn:
+            for key in keys:
+                self._delete(conn, tier, key)
+
+    def search(self, query: str, prefix: bool = False, page: int = 1, page_size: int = 20) -> Dict[str, Any]:
+        """Ranked, paginated search; each hit lists the pages that mention the query terms"""
+        terms = self._build_terms(query, prefix)
+        response = {"query": query, "total": 0, "total_is_estimate": False,
+                    "page": page, "page_size": page_size, "results": []}
+        if not terms:
+            return response
+
+        match_all = " ".join(terms)
+        conn = self._connection()
+
+        # Counting every hit of a common term is what makes searches slow, so the count is capped
+        counted = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT 1 FROM documents_fts WHERE documents_fts MATCH ? LIMIT ?)",
+            (match_all, self.max_counted_hits + 1)
+        ).fetchone()[0]
+        response["total"] = min(counted, self.max_counted_hits)
+        response["total_is_estimate"] = counted > self.max_counted_hits
+
+        # Score only the most recently added matches; walking by rowid stops after the limit,
+        # whereas ORDER BY rank would score every match
+        offset = (max(page, 1) - 1) * page_size
+        candidates = max(self.ranked_candidates, offset + page_size)
+        rows = conn.execute(
+            """
+            SELECT d.doc_rowid, d.tier, d.key, d.filename, f.score
+            FROM (
+                SELECT rowid, bm25(documents_fts) AS score FROM documents_fts WHERE documents_fts MATCH ?
+                ORDER BY rowid DESC LIMIT ?
+            ) f
+            JOIN documents d ON d.doc_rowid = f.rowid
+            ORDER BY f.score, f.rowid DESC LIMIT ? OFFSET ?
+            """,
+            (match_all, candidates, page_size, offset)
+        ).fetchall()
+
+        page_hits = self._page_hits(conn, [row[0] for row in rows], " OR ".join(terms)) if rows else {}
+        for doc_rowid, tier, key, filename, score in rows:
+            pages, snippet = page_hits.get(doc_rowid, ([], None))
+            response["results"].append({
+                "tier": tier,
+                "key": key,
+                "file_id": key,
+                "filename": filename,
+                # bm25 is lower-is-better; flip the sign so higher means more relevant
+                "score": -score,
+                "pages": sorted(set(pages)),
+                "snippet": snippet
+            })
+
+        return response
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _delete(self, conn: sqlite3.Connection, tier: str, key: str) -> Optional[int]:
+        """Remove a document's FTS rows, returning its rowid for reuse; caller holds the write lock"""
+        row = conn.execute("SELECT doc_rowid FROM documents WHERE tier = ? AND key = ?", (tier, key)).fetchone()
+        if row is None:
+            return None
+        doc_rowid = row[0]
+
+        page_rows = conn.execute(
+            "SELECT p.rowid, f.content FROM pages p JOIN pages_fts f ON f.rowid = p.rowid "
+            "WHERE p.doc_rowid = ? ORDER BY p.rowid",
+            (doc_rowid,)
+        ).fetchall()
+        # Contentless tables need the originally indexed text to delete a row
+        conn.execute(
+            "INSERT INTO documents_fts (documents_fts, rowid, content) VALUES ('delete', ?, ?)",
+            (doc_rowid, self._document_text(content for _, content in page_rows))
+        )
+        conn.execute("DELETE FROM pages_fts WHERE rowid IN (SELECT rowid FROM pages WHERE doc_rowid = ?)",
+                     (doc_rowid,))
+        conn.execute("DELETE FROM pages WHERE doc_rowid = ?", (doc_rowid,))
+        conn.execute("DELETE FROM documents WHERE doc_rowid = ?", (doc_rowid,))
+        return doc_rowid
+
+    def _page_hits(self, conn: sqlite3.Connection, doc_rowids: List[int],
+                   match_any: str) -> Dict[int, Tuple[List[int], Optional[str]]]:
+        """Pages of each document that contain any query term, plus a snippet from the first of them
+
+        One query covers every document on the results page: a prefix longer
+        than the prefix index is expanded over the whole table on each MATCH,
+        so it is paid once rather than per document.
+        """
+        placeholders = ",".join("?" * len(doc_rowids))
+        bounds = conn.execute(
+            f"SELECT MIN(rowid), MAX(rowid) FROM pages WHERE doc_rowid IN ({placeholders})", doc_rowids
+        ).fetchone()
+        if bounds[0] is None:
+            return {}
+
+        # A document's pages have contiguous rowids, so the match can seek straight to them.
+        # Pages are not ranked: bm25 rescans every page holding the terms to weigh a handful
+        hits: Dict[int, Tuple[List[int], Optional[str]]] = {}
+        rows = conn.execute(
+            "SELECT p.doc_rowid, p.page_number, snippet(pages_fts, 0, '[', ']', '...', 12) FROM pages_fts "
+            "JOIN pages p ON p.rowid = pages_fts.rowid "
+            f"WHERE pages_fts MATCH ? AND pages_fts.rowid BETWEEN ? AND ? AND p.doc_rowid IN ({placeholders}) "
+            "ORDER BY pages_fts.rowid",
+            (match_any, bounds[0], bounds[1], *doc_rowids)
+        )
+        for doc_rowid, page_number, snippet in rows:
+            pages, first_snippet = hits.get(doc_rowid, ([], snippet))
+            if page_number is not None:
+                pages.append(page_number)
+            hits[doc_rowid] = (pages, first_snippet)
+        return hits
+
+    def _build_terms(self, query: str, prefix: bool) -> List[str]:
+        """Turn free text into quoted FTS5 terms"""
+        terms = []
+        for raw in query.split():
+            term_prefix = prefix or raw.endswith("*")
+            term = raw.rstrip("*").replace('"', '""')
+            if not re.search(r"\w", term):
+                continue
+            terms.append(f'"{term}"*' if term_prefix else f'"{term}"')
+        return terms
+
+    def _document_text(self, page_texts) -> str:
+        return "\n".join(page_texts)
+
+    def _split_pages(self, content: str, pages: List[Any]) -> List[Tuple[Optional[int], str]]:
+        """Slice the document content into pages using each page's spans"""
+        split = []
+        for page in pages:
+            if not isinstance(page, Mapping):
+                continue
+            text = "\n".join(
+                content[span["offset"]:span["offset"] + span["length"]]
+                for span in page.get("spans") or []
+            )
+            split.append((page.get("pageNumber"), text))
+
+        # Fall back to a single unnumbered page when page spans are unavailable
+        return split or [(None, content)]
+
+
+def index_directory(index: SearchIndex, tier: str, json_dir: Path) -> int:
+    """Index every sharded JSON result of one storage tier"""
+    storage = StorageTier(json_dir, key_from_name=TIER_KEY_FUNCTIONS[tier])
+    indexed = 0
+    for entry in storage.iter_files():
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            with open(entry.path, 'r', encoding='utf-8') as f:
+                preap_data = json.load(f)
+            index.add_document(tier, storage.key_from_name(entry.name), preap_data, entry.name)
+            indexed += 1
+        except Exception as e:
+            print(f"Failed to index {entry.name}: {e}")
+    return indexed
+
+
+def main():
+    """Rebuild the search index from processed JSON files"""
+    parser = argparse.ArgumentParser(description="Index processed invoice JSON for full-text search")
+    parser.add_argument("--json-dir", default="processed_json", help="API processed JSON directory")
+    parser.add_argument("--output", default="preap_output", help="Batch PREAP output directory")
+    parser.add_argument("--db", default="search_index/index.db", help="Search index database")
+    args = parser.parse_args()
+
+    index = SearchIndex(Path(args.db))
+    indexed = index.rebuild({TIER_PROCESSED_JSON: Path(args.json_dir), TIER_PREAP_OUTPUT: Path(args.output)})
+    index.close()
+    print(f"Indexed {indexed} documents")
+
+
+if __name__ == "__main__":
+    main()
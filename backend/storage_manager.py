@@ -0,0 +1,481 @@
+"""
+Bounded, sharded storage for uploaded PDFs and processed JSON results
+"""
+
+import os
+import json
+import time
+import hashlib
+import zipfile
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+EVICT_DELETE = "delete"
+EVICT_ARCHIVE = "archive"
+
+_HEX = set("0123456789abcdef")
+
+
+def key_before_underscore(name: str) -> str:
+    """Key for '<file_id>_<original name>' style files"""
+    return name.split("_", 1)[0]
+
+
+def key_from_stem(name: str) -> str:
+    """Key for '<stem>.json' style files"""
+    return Path(name).stem
+
+
+class ArchiveStore:
+    """Compressed zip bundles with a key -> (bundle, member) index"""
+
+    def __init__(self, root: Path, bundle_max_entries: int = 1000, max_bytes: Optional[int] = None,
+                 min_live_ratio: float = 0.5):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.bundle_max_entries = bundle_max_entries
+        self.max_bytes = max_bytes
+        self.min_live_ratio = min_live_ratio
+        self.index_path = self.root / "index.json"
+        self._lock = threading.Lock()
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        if self._index is None:
+            if self.index_path.exists():
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self._index = json.load(f)
+            else:
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def add(self, entries: List[Tuple[str, Path]], compress: bool = True) -> int:
+        """Move files into new bundles; returns the number of files archived"""
+        archived = 0
+        compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+
+        for start in range(0, len(entries), self.bundle_max_entries):
+            chunk = entries[start:start + self.bundle_max_entries]
+            bundle_name, tmp_path = self._new_bundle()
+
+            # Zip outside the lock so lookups and reads never wait on a maintenance pass
+            members = {}
+            with zipfile.ZipFile(tmp_path, 'w', compression=compression, strict_timestamps=False) as bundle:
+                for key, path in chunk:
+                    stat = path.stat()
+                    bundle.write(path, arcname=path.name)
+                    members[key] = {
+                        "bundle": bundle_name,
+                        "member": path.name,
+                        "size": stat.st_size,
+                        "modified": stat.st_mtime
+                    }
+            self._commit(tmp_path, bundle_name, members)
+
+            # Only drop the originals once the bundle and index are durable
+            for _, path in chunk:
+                path.unlink(missing_ok=True)
+            archived += len(chunk)
+
+        return archived
+
+    def compact(self) -> Dict[str, int]:
+        """Drop bundles with no live members and rewrite mostly superseded ones
+
+        Re-archiving a key leaves its previous member orphaned; compaction
+        reclaims that space so the archive only holds current results.
+        """
+        # Bundles only gain keys when they are committed, so a snapshot is enough to plan from
+        with self._lock:
+            live = defaultdict(dict)
+            for key, entry in self._load_index().items():
+                live[entry["bundle"]][key] = entry["member"]
+            bundle_paths = sorted(self.root.glob("bundle-*.zip"))
+
+        removed = 0
+        sparse = []
+        for bundle_path in bundle_paths:
+            members = live.get(bundle_path.name)
+            if not members:
+                bundle_path.unlink(missing_ok=True)
+                removed += 1
+                continue
+            with zipfile.ZipFile(bundle_path, 'r') as bundle:
+                member_count = len(bundle.infolist())
+            if len(members) / member_count < self.min_live_ratio:
+                sparse.append((bundle_path, members))
+
+        if sparse:
+            self._rewrite(sparse)
+        self._remove_stale_tmp()
+        return {"removed_bundles": removed, "rewritten_bundles": len(sparse)}
+
+    def enforce_budget(self) -> List[str]:
+        """Drop the bundles holding the oldest results until the archive fits its size budget
+
+        Bundles are ordered by the newest member they hold, as recorded in the
+        index, so rewritten bundles keep the age of the results inside them.
+        Returns the keys dropped.
+        """
+        if self.max_bytes is None:
+            return []
+        with self._lock:
+            index = self._load_index()
+            newest: Dict[str, float] = {}
+            for entry in index.values():
+                newest[entry["bundle"]] = max(newest.get(entry["bundle"], 0.0), entry.get("modified", 0.0))
+            bundles = [(newest.get(path.name, 0.0), path) for path in self.root.glob("bundle-*.zip")]
+            bundles.sort(key=lambda bundle: bundle[0])
+            total_bytes = sum(path.stat().st_size for _, path in bundles)
+
+            expired = set()
+            for _, path in bundles:
+                if total_bytes <= self.max_bytes:
+                    break
+                total_bytes -= path.stat().st_size
+                expired.add(path.name)
+
+            dropped = [key for key, entry in index.items() if entry["bundle"] in expired]
+            for key in dropped:
+                del index[key]
+            if expired:
+                self._save_index()
+
+        for name in expired:
+            (self.root / name).unlink(missing_ok=True)
+        return dropped
+
+    def _rewrite(self, sparse: List[Tuple[Path, Dict[str, str]]]):
+        """Copy the live members of sparse bundles into fresh bundles"""
+        live_members = [(bundle_path, key, member) for bundle_path, members in sparse
+                        for key, member in members.items()]
+        for start in range(0, len(live_members), self.bundle_max_entries):
+            chunk = live_members[start:start + self.bundle_max_entries]
+            bundle_name, tmp_path = self._new_bundle()
+            with zipfile.ZipFile(tmp_path, 'w') as target:
+                for bundle_path, _, member in chunk:
+                    with zipfile.ZipFile(bundle_path, 'r') as source:
+                        info = source.getinfo(member)
+                        target.writestr(info, source.read(info), compress_type=info.compress_type)
+            # Keys re-archived or dropped while copying keep their newer index entry
+            self._commit(tmp_path, bundle_name, {key: bundle_path.name for bundle_path, key, _ in chunk},
+                         moved=True)
+
+        for bundle_path, _ in sparse:
+            bundle_path.unlink(missing_ok=True)
+
+    def _commit(self, tmp_path: Path, bundle_name: str, updates: Dict[str, Any], moved: bool = False):
+        """Publish a written bundle and point its keys at it
+
+        updates maps key -> index entry for new members, or key -> source
+        bundle name when moved is set; moved keys are only re-pointed if they
+        still live in that source bundle.
+        """
+        with self._lock:
+            os.replace(tmp_path, self.root / bundle_name)
+            index = self._load_index()
+            for key, update in updates.items():
+                if not moved:
+                    index[key] = update
+                elif key in index and index[key]["bundle"] == update:
+                    index[key]["bundle"] = bundle_name
+            self._save_index()
+
+    def _new_bundle(self) -> Tuple[str, Path]:
+        """Name for a new bundle and the temporary path it is written to"""
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        bundle_name = f"bundle-{stamp}-{uuid4().hex[:8]}.zip"
+        return bundle_name, self.root / f"{bundle_name}.tmp"
+
+    def _remove_stale_tmp(self, max_age_seconds: float = 86400):
+        """Clean up bundles left half-written by an interrupted maintenance pass"""
+        now = time.time()
+        for tmp_path in self.root.glob("bundle-*.zip.tmp"):
+            try:
+                if now - tmp_path.stat().st_mtime > max_age_seconds:
+                    tmp_path.unlink()
+            except OSError:
+                pass
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._load_index().get(key)
+
+    def read(self, key: str) -> Optional[Tuple[str, bytes]]:
+        """Return (file name, content) for an archived key"""
+        for _ in range(2):
+            entry = self.lookup(key)
+            if not entry:
+                return None
+            try:
+                with zipfile.ZipFile(self.root / entry["bundle"], 'r') as bundle:
+                    return entry["member"], bundle.read(entry["member"])
+            except FileNotFoundError:
+                # Compaction moved the key to a new bundle after the lookup
+                continue
+        return None
+
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return dict(self._load_index())
+
+
+class StorageTier:
+    """A directory sharded by hashed key with size and age budgets"""
+
+    def __init__(self, root: Path, key_from_name: Callable[[str], str] = key_before_underscore,
+                 max_bytes: Optional[int] = None, max_age_seconds: Optional[float] = None,
+                 on_evict: str = EVICT_DELETE, archive: Optional[ArchiveStore] = None,
+                 compress_archive: bool = True, on_remove: Optional[Callable[[List[str]], None]] = None):
+        if on_evict == EVICT_ARCHIVE and archive is None:
+            raise ValueError("Archive eviction requires an ArchiveStore")
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.key_from_name = key_from_name
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.on_evict = on_evict
+        self.archive = archive
+        self.compress_archive = compress_archive
+        # Called with keys whose file is gone for good, e.g. to drop them from the search index
+        self.on_remove = on_remove
+
+    def shard_dir(self, key: str) -> Path:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return self.root / digest[:2] / digest[2:4]
+
+    def path_for(self, key: str, filename: str) -> Path:
+        """Where a new file for key should be written"""
+        shard = self.shard_dir(key)
+        shard.mkdir(parents=True, exist_ok=True)
+        return shard / filename
+
+    def find(self, key: str) -> Optional[Path]:
+        """Locate the hot file for key, including legacy flat files"""
+        for directory in (self.shard_dir(key), self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory):
+                if entry.is_file() and self.key_from_name(entry.name) == key:
+                    return Path(entry.path)
+        return None
+
+    def exists(self, key: str) -> bool:
+        return self.find(key) is not None or (
+            self.archive is not None and self.archive.lookup(key) is not None
+        )
+
+    def read(self, key: str) -> Optional[Tuple[str, bytes]]:
+        """Return (file name, content) from the hot tier or the archive"""
+        path = self.find(key)
+        if path:
+            self.touch(path)
+            return path.name, path.read_bytes()
+        if self.archive:
+            return self.archive.read(key)
+        return None
+
+    def touch(self, path: Path):
+        """Mark a file as recently used for LRU eviction
+
+        Only the access time moves; the modification time stays the write
+        time that the age budget is measured from.
+        """
+        try:
+            os.utime(path, (time.time(), path.stat().st_mtime))
+        except OSError:
+            pass
+
+    def iter_files(self) -> Iterator[os.DirEntry]:
+        """Walk every sharded file (files left at the root are not part of the tier)"""
+        for level1 in os.scandir(self.root):
+            if not self._is_shard(level1):
+                continue
+            for level2 in os.scandir(level1.path):
+                if not self._is_shard(level2):
+                    continue
+                for entry in os.scandir(level2.path):
+                    if entry.is_file():
+                        yield entry
+
+    def migrate_flat_files(self, pattern: str = "*", exclude: Iterable[str] = ()) -> int:
+        """Move legacy files from the tier root into their shards"""
+        moved = 0
+        exclude = set(exclude)
+        for path in self.root.glob(pattern):
+            if path.is_file() and path.name not in exclude:
+                os.replace(path, self.path_for(self.key_from_name(path.name), path.name))
+                moved += 1
+        return moved
+
+    def enforce_budget(self) -> Dict[str, int]:
+        """Evict files past the age budget, then least recently used ones until under the size budget
+
+        Age is measured from when a file was written (mtime) and recency from
+        when it was last used (atime, advanced by touch), so files that are
+        viewed now and then still expire.
+        """
+        now = time.time()
+        files = []
+        total_bytes = 0
+        victims = []
+        for entry in self.iter_files():
+            stat = entry.stat()
+            total_bytes += stat.st_size
+            if self.max_age_seconds is not None and now - stat.st_mtime > self.max_age_seconds:
+                victims.append(Path(entry.path))
+                total_bytes -= stat.st_size
+                continue
+            last_used = max(stat.st_atime, stat.st_mtime)
+            files.append((last_used, stat.st_size, Path(entry.path)))
+        scanned = len(files) + len(victims)
+
+        files.sort(key=lambda f: f[0])
+        for _, size, path in files:
+            if self.max_bytes is None or total_bytes <= self.max_bytes:
+                break
+            victims.append(path)
+            total_bytes -= size
+
+        evicted = self._evict(victims)
+        result = {"scanned": scanned, "evicted": evicted, "bytes": total_bytes}
+        if self.archive:
+            result["archive"] = self.archive.compact()
+            # A dropped key may have been written again since it was archived
+            dropped = [key for key in self.archive.enforce_budget() if self.find(key) is None]
+            result["archive"]["dropped"] = len(dropped)
+            self._removed(dropped)
+        return result
+
+    def _evict(self, paths: List[Path]) -> int:
+        if not paths:
+            return 0
+        if self.on_evict == EVICT_ARCHIVE:
+            entries = [(self.key_from_name(path.name), path) for path in paths]
+            return self.archive.add(entries, compress=self.compress_archive)
+        for path in paths:
+            path.unlink(missing_ok=True)
+        self._removed([self.key_from_name(path.name) for path in paths])
+        return len(paths)
+
+    def _removed(self, keys: List[str]):
+        if not keys or self.on_remove is None:
+            return
+        try:
+            self.on_remove(keys)
+        except Exception as e:
+            print(f"Failed to report {len(keys)} removed files: {e}")
+
+    def _is_shard(self, entry: os.DirEntry) -> bool:
+        return entry.is_dir() and len(entry.name) == 2 and set(entry.name) <= _HEX
+
+
+class StorageManager:
+    """Storage tiers used by the API: uploaded PDFs and processed JSON"""
+
+    def __init__(self, upload_dir: Path, json_dir: Path,
+                 pdf_max_bytes: Optional[int] = None, pdf_max_age_days: Optional[float] = None,
+                 pdf_eviction: str = EVICT_DELETE,
+                 pdf_archive_max_bytes: Optional[int] = None,
+                 json_archive_after_days: Optional[float] = None, json_max_bytes: Optional[int] = None,
+                 json_archive_max_bytes: Optional[int] = None,
+                 bundle_max_entries: int = 1000, maintenance_interval: float = 3600,
+                 on_json_removed: Optional[Callable[[List[str]], None]] = None):
+        self.uploads = StorageTier(
+            upload_dir,
+            key_from_name=key_before_underscore,
+            max_bytes=pdf_max_bytes,
+            max_age_seconds=_days_to_seconds(pdf_max_age_days),
+            on_evict=pdf_eviction,
+            archive=ArchiveStore(
+                upload_dir / "archive", bundle_max_entries, pdf_archive_max_bytes
+            ) if pdf_eviction == EVICT_ARCHIVE else None,
+            compress_archive=False  # PDFs are already compressed
+        )
+        self.processed_json = StorageTier(
+            json_dir,
+            key_from_name=key_before_underscore,
+            max_bytes=json_max_bytes,
+            max_age_seconds=_days_to_seconds(json_archive_after_days),
+            on_evict=EVICT_ARCHIVE,
+            archive=ArchiveStore(json_dir / "archive", bundle_max_entries, json_archive_max_bytes),
+            on_remove=on_json_removed
+        )
+        self.maintenance_interval = maintenance_interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls, upload_dir: Path, json_dir: Path,
+                 on_json_removed: Optional[Callable[[List[str]], None]] = None) -> "StorageManager":
+        return cls(
+            upload_dir,
+            json_dir,
+            pdf_max_bytes=_env_int("STORAGE_PDF_MAX_BYTES"),
+            pdf_max_age_days=_env_float("STORAGE_PDF_MAX_AGE_DAYS"),
+            pdf_eviction=os.getenv("STORAGE_PDF_EVICTION", EVICT_DELETE),
+            pdf_archive_max_bytes=_env_int("STORAGE_PDF_ARCHIVE_MAX_BYTES"),
+            json_archive_after_days=_env_float("STORAGE_JSON_ARCHIVE_AFTER_DAYS"),
+            json_max_bytes=_env_int("STORAGE_JSON_MAX_BYTES"),
+            json_archive_max_bytes=_env_int("STORAGE_JSON_ARCHIVE_MAX_BYTES"),
+            bundle_max_entries=_env_int("STORAGE_BUNDLE_MAX_ENTRIES") or 1000,
+            maintenance_interval=_env_float("STORAGE_MAINTENANCE_INTERVAL") or 3600,
+            on_json_removed=on_json_removed
+        )
+
+    def migrate(self):
+        """Shard files written by older versions into the new layout"""
+        moved = self.uploads.migrate_flat_files("*.pdf")
+        moved += self.processed_json.migrate_flat_files("*.json")
+        if moved:
+            print(f"Migrated {moved} files into sharded storage")
+
+    def run_maintenance(self) -> Dict[str, Any]:
+        """Apply size and age budgets to every tier"""
+        return {
+            "uploads": self.uploads.enforce_budget(),
+            "processed_json": self.processed_json.enforce_budget()
+        }
+
+    def start(self):
+        """Start periodic maintenance in a background thread"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._maintenance_loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _maintenance_loop(self):
+        while not self._stop.is_set():
+            try:
+                result = self.run_maintenance()
+                print(f"Storage maintenance: {result}")
+            except Exception as e:
+                print(f"Storage maintenance failed: {e}")
+            self._stop.wait(self.maintenance_interval)
+
+
+def _days_to_seconds(days: Optional[float]) -> Optional[float]:
+    return days * 86400 if days is not None else None
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else None